@@ -2,13 +2,33 @@
 # This file contains the agent backends, defining the "brains" of the operation.
 # It includes a mock agent for testing and a real agent that connects to Hugging Face models.
 
+import asyncio
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
 _TRANSFORMERS_OK = False
 try:
-    from transformers import pipeline
+    import torch
+    from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer, BitsAndBytesConfig, StoppingCriteriaList, pipeline
     _TRANSFORMERS_OK = True
 except ImportError:
     pipeline = None
 
+_GENERATION_KWARGS = {"max_new_tokens": 200, "do_sample": True, "temperature": 0.7}
+# The moderator makes a control decision, not prose: greedy decoding and a short budget are enough.
+_MODERATOR_GENERATION_KWARGS = {"max_new_tokens": 32, "do_sample": False}
+_GEN_BATCH_SIZE = 4
+
+# The moderator's decision is made by whichever of these it emits first.
+_VERDICT_MARKERS = ("CONCLUSION:", "NEXT_STEP:")
+_VERDICT_TAIL_TOKENS = 20
+_TOKENIZE_CACHE_SIZE = 32
+_OUTPUT_CUE = "\nOutput:"  # every text-generation prompt ends with this
+
+# Loaded pipelines keyed by (task, model_name, precision), so agents and scenarios share warm weights.
+_PIPE_CACHE: Dict[Tuple[str, str, str], Any] = {}
+
 class FakeLLM:
     """A deterministic, rule-based mock agent for fast and reliable unit testing."""
     def __init__(self, role: str):
@@ -35,36 +55,189 @@ class FakeLLM:
                 return "NEXT_STEP: The research is incomplete."
         return f"Unhandled role {self.role}"
 
+    async def agenerate(self, task: str, board: str) -> str:
+        return self.generate(task, board)
+
+def _model_load_kwargs(precision: str) -> Dict[str, Any]:
+    """Maps the PRECISION setting (bf16, int8 or fp32) to from_pretrained() arguments."""
+    if precision == "bf16":
+        return {"torch_dtype": torch.bfloat16, "device_map": "auto"}
+    if precision == "int8":
+        # Requires the optional bitsandbytes package and a CUDA device.
+        return {"quantization_config": BitsAndBytesConfig(load_in_8bit=True), "device_map": "auto"}
+    if precision == "fp32":
+        return {"torch_dtype": torch.float32}
+    raise ValueError(f"Unsupported PRECISION '{precision}', expected one of: bf16, int8, fp32")
+
+def load_pipeline(task: str, model_name: str) -> Any:
+    """Returns the pipeline for (task, model_name), loading it on first use and reusing it afterwards.
+
+    Weights are loaded at the precision named by the PRECISION environment variable (default bf16);
+    set PRECISION=fp32 to keep full-precision weights (e.g. when comparing outputs in tests).
+    """
+    precision = os.environ.get("PRECISION", "bf16").lower()
+    key = (task, model_name, precision)
+    if key not in _PIPE_CACHE:
+        model_cls = AutoModelForCausalLM if task == "text-generation" else AutoModelForSeq2SeqLM
+        model = model_cls.from_pretrained(model_name, trust_remote_code=True, **_model_load_kwargs(precision))
+        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+        if task == "text-generation":
+            if tokenizer.pad_token_id is None:
+                # Batching needs a pad token; decoder-only models must be padded on the left.
+                tokenizer.pad_token_id = model.config.eos_token_id
+                tokenizer.padding_side = "left"
+            pipe = pipeline(task, model=model, tokenizer=tokenizer, batch_size=_GEN_BATCH_SIZE)
+        else:
+            pipe = pipeline(task, model=model, tokenizer=tokenizer)
+        _PIPE_CACHE[key] = pipe
+    return _PIPE_CACHE[key]
+
+class _VerdictStop:
+    """Stopping criterion that ends generation a few tokens after a verdict marker appears.
+
+    Follows the transformers StoppingCriteria interface, so it can be passed via StoppingCriteriaList.
+    """
+    def __init__(self, tokenizer: Any, markers: Tuple[str, ...] = _VERDICT_MARKERS, tail_tokens: int = _VERDICT_TAIL_TOKENS):
+        self.tokenizer = tokenizer
+        self.markers = markers
+        self.tail_tokens = tail_tokens
+        self._prompt_len: Optional[int] = None
+        self._marker_at: Optional[int] = None
+
+    def __call__(self, input_ids: Any, scores: Any, **kwargs: Any) -> Any:
+        if self._prompt_len is None:
+            # First call happens after one new token has been appended to the prompt.
+            self._prompt_len = input_ids.shape[-1] - 1
+        generated = input_ids.shape[-1] - self._prompt_len
+        if self._marker_at is None:
+            text = self.tokenizer.decode(input_ids[0, self._prompt_len:], skip_special_tokens=True)
+            if any(marker in text for marker in self.markers):
+                self._marker_at = generated
+        done = self._marker_at is not None and generated - self._marker_at >= self.tail_tokens
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
 class HuggingFaceAgent:
     """An agent that uses real AI models from the Hugging Face Hub."""
-    def __init__(self, role: str, model_name: str):
+    # Tokenized inputs keyed by (model_name, text), shared by all agents. Fixed inputs such as the
+    # meeting transcript are tokenized once and then fed straight to model.generate().
+    _tokenize_cache: Dict[Tuple[str, str], Any] = {}
+    _tokenize_lock = threading.Lock()  # agents generate from worker threads
+
+    def __init__(self, role: str, model_name: str, pipe: Any = None):
         self.role = role
-        task = "summarization" if "Summarizer" in role or "Analysis" in role else "text-generation"
-        self.pipe = pipeline(task, model=model_name, trust_remote_code=True)
+        self.model_name = model_name
+        self.is_summarizer = "Summarizer" in role or "Analysis" in role
+        task = "summarization" if self.is_summarizer else "text-generation"
+        self.pipe = pipe if pipe is not None else load_pipeline(task, model_name)
+        self.gen_kwargs = _MODERATOR_GENERATION_KWARGS if role == "Moderator" else _GENERATION_KWARGS
+        # KV cache of the last prompt prefix this agent prefilled, and the token ids it covers.
+        self._prefix_ids: Any = None
+        self._prefix_cache: Any = None
+
+    @property
+    def batch_key(self) -> Optional[Tuple[int, str]]:
+        """Agents with equal keys can share one batched pipeline call; None means the agent is not batchable."""
+        if self.is_summarizer:
+            return None
+        return id(self.pipe), repr(sorted(self.gen_kwargs.items()))
+
+    def _build_prompt(self, task: str, board: str) -> str:
+        if self.role == "ResearchBot":
+            return f"Instruct: You are a research assistant. Provide a detailed, factual summary of the following topic.\nInput: {task}\nOutput:"
+        if self.role == "CreativeBot":
+            return f"Instruct: You are a creative writer. Write an engaging narrative based on the provided text.\nInput: {board}\nOutput:"
+        return f"Instruct: Analyze the following text and perform this task: {task}\nInput: {board}\nOutput:"
+
+    def _encode(self, text: str) -> Any:
+        key = (self.model_name, text)
+        with self._tokenize_lock:
+            inputs = self._tokenize_cache.get(key)
+        if inputs is None:
+            inputs = self.pipe.tokenizer(text, return_tensors="pt", truncation=self.is_summarizer).to(self.pipe.model.device)
+            with self._tokenize_lock:
+                if len(self._tokenize_cache) >= _TOKENIZE_CACHE_SIZE:
+                    self._tokenize_cache.pop(next(iter(self._tokenize_cache)))
+                self._tokenize_cache[key] = inputs
+        return inputs
+
+    def _generate_from_text(self, text: str, **gen_kwargs: Any) -> str:
+        """Calls model.generate() on cached input ids, bypassing the pipeline's tokenization step."""
+        inputs = self._encode(text)
+        output_ids = self.pipe.model.generate(**inputs, pad_token_id=self.pipe.tokenizer.pad_token_id, **gen_kwargs)
+        if not self.is_summarizer:
+            # Decoder-only models echo the prompt; keep only the new tokens.
+            output_ids = output_ids[:, inputs["input_ids"].shape[-1]:]
+        return self.pipe.tokenizer.decode(output_ids[0], skip_special_tokens=True, clean_up_tokenization_spaces=True).strip()
+
+    def _generate_with_prefix_cache(self, prefix: str, suffix: str, **gen_kwargs: Any) -> str:
+        """Generates from prefix + suffix, prefilling only the part of prefix not already in the KV cache.
+
+        When prefix extends the prefix of the previous call (as the append-only board does round to round),
+        attention keys/values for the shared tokens are reused instead of being recomputed.
+        """
+        model, tokenizer = self.pipe.model, self.pipe.tokenizer
+        prefix_ids = self._encode(prefix)["input_ids"]
+        reused = 0 if self._prefix_ids is None else self._prefix_ids.shape[-1]
+        if reused == 0 or reused > prefix_ids.shape[-1] or not torch.equal(prefix_ids[:, :reused], self._prefix_ids):
+            # Not an extension of the cached prefix (e.g. a new task); start over.
+            reused, self._prefix_cache = 0, None
+        if prefix_ids.shape[-1] > reused:
+            with torch.no_grad():
+                out = model(input_ids=prefix_ids[:, reused:], past_key_values=self._prefix_cache, use_cache=True)
+            self._prefix_cache = out.past_key_values
+        self._prefix_ids = prefix_ids
+
+        input_ids = torch.cat([prefix_ids, self._encode(suffix)["input_ids"]], dim=-1)
+        # generate() only runs the tokens past the cache; the legacy-format cache tuple is not modified in place.
+        output_ids = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=self._prefix_cache,
+            pad_token_id=tokenizer.pad_token_id,
+            **gen_kwargs,
+        )
+        return tokenizer.decode(output_ids[0, input_ids.shape[-1]:], skip_special_tokens=True).strip()
+
+    def _parse_output(self, response: List[Dict[str, str]]) -> str:
+        full_response = response[0]['generated_text']
+        output_start = full_response.find("Output:")
+        if output_start != -1:
+            return full_response[output_start + len("Output:"):].strip()
+        return full_response
 
     def generate(self, task: str, board: str) -> str:
-        if "Summarizer" in self.role or "Analysis" in self.role:
+        if self.is_summarizer:
             try:
                 text_to_summarize = board if len(board) > 50 else task
-                response = self.pipe(text_to_summarize, max_length=100, min_length=20, truncation=True)
-                return response[0]['summary_text']
+                return self._generate_from_text(text_to_summarize, max_length=100, min_length=20)
             except Exception as e:
                 return f"Error during summarization: {e}"
         
-        prompt = ""
-        if self.role == "ResearchBot":
-            prompt = f"Instruct: You are a research assistant. Provide a detailed, factual summary of the following topic.\nInput: {task}\nOutput:"
-        elif self.role == "CreativeBot":
-            prompt = f"Instruct: You are a creative writer. Write an engaging narrative based on the provided text.\nInput: {board}\nOutput:"
-        else: 
-            prompt = f"Instruct: Analyze the following text and perform this task: {task}\nInput: {board}\nOutput:"
-        
+        gen_kwargs: Dict[str, Any] = dict(self.gen_kwargs)
+        if self.role == "Moderator":
+            # The verdict is decided by the first few tokens; stop shortly after it instead of running to max_new_tokens.
+            gen_kwargs["stopping_criteria"] = StoppingCriteriaList([_VerdictStop(self.pipe.tokenizer)])
         try:
-            response = self.pipe(prompt, max_new_tokens=200, do_sample=True, temperature=0.7)
-            full_response = response[0]['generated_text']
-            output_start = full_response.find("Output:")
-            if output_start != -1:
-                return full_response[output_start + len("Output:"):].strip()
-            return full_response
+            prompt = self._build_prompt(task, board)
+            if self.role == "Moderator":
+                # The moderator re-reads the growing board every round; keep the board's KV cache warm.
+                return self._generate_with_prefix_cache(prompt[:-len(_OUTPUT_CUE)], _OUTPUT_CUE, **gen_kwargs)
+            return self._generate_from_text(prompt, **gen_kwargs)
         except Exception as e:
-            return f"Error generating text: {e}"
\ No newline at end of file
+            return f"Error generating text: {e}"
+
+    async def agenerate(self, task: str, board: str) -> str:
+        # Pipelines block on inference, so run them off the event loop.
+        return await asyncio.to_thread(self.generate, task, board)
+
+def generate_batch(agents: List[HuggingFaceAgent], task: str, board: str) -> List[str]:
+    """Runs text-generation agents with the same batch_key as a single batched forward pass."""
+    prompts = [agent._build_prompt(task, board) for agent in agents]
+    try:
+        responses = agents[0].pipe(prompts, **agents[0].gen_kwargs)
+        return [agent._parse_output(response) for agent, response in zip(agents, responses)]
+    except Exception as e:
+        return [f"Error generating text: {e}"] * len(agents)
+
+async def agenerate_batch(agents: List[HuggingFaceAgent], task: str, board: str) -> List[str]:
+    return await asyncio.to_thread(generate_batch, agents, task, board)
\ No newline at end of file
@@ -2,6 +2,7 @@
 # This is the main entry point for the application. Its primary role is to
 # orchestrate the high-level workflow: running tests and then executing the main demos.
 
+import asyncio
 import os
 from orchestrator import Orchestrator, HistoryStore
 from agents import _TRANSFORMERS_OK
@@ -16,7 +17,8 @@ def run_research_demo(topic: str, use_hf: bool = False, rounds: int = 2) -> None
     
     store = HistoryStore(path=db_path)
     orch = Orchestrator(store=store, rounds=rounds, use_hf=use_hf)
-    orch.run_research_collaboration(topic)
+    asyncio.run(orch.arun_research_collaboration(topic))
+    store.close()
 
 def run_schedule_demo(meeting_id: str) -> None:
     """Runs a demonstration of the schedule optimization agent (Scenario 2)."""
@@ -28,7 +30,8 @@ def run_schedule_demo(meeting_id: str) -> None:
     orch = Orchestrator(store=store, use_hf=True, rounds=1)
     
     transcript = get_meeting_transcript(meeting_id)
-    orch.run_schedule_optimization(transcript)
+    asyncio.run(orch.arun_schedule_optimization(transcript))
+    store.close()
 
 def test_history_created() -> None:
     """Unit test to verify that the HistoryStore correctly creates a database."""
@@ -39,6 +42,7 @@ def test_history_created() -> None:
     orch = Orchestrator(store=HistoryStore(path), rounds=1)
     _ = orch.run_research_collaboration("What is the capital of France?")
     assert os.path.exists(path), "Expected test db to be created"
+    orch.store.close()
     os.remove(path)
     print("PASS")
 
@@ -52,10 +56,11 @@ def test_research_path() -> None:
     _ = orch.run_research_collaboration("What is the capital of India?")
     
     # FIX: Restored the assertion to make the test meaningful.
-    rows = orch.store.latest(10)
-    research_answers = [c.answer for c in rows if c.role == "ResearchBot"]
+    rows = orch.store.latest(10, role="ResearchBot")
+    research_answers = [c.answer for c in rows]
     assert any("New Delhi" in a for a in research_answers), "Expected ResearchBot to answer 'New Delhi'"
     
+    orch.store.close()
     os.remove(path)
     print("PASS")
 
@@ -2,17 +2,41 @@
 # This file contains the core logic for the multi-agent system, including
 # the Orchestrator that manages the workflow and the HistoryStore for data persistence.
 
+import asyncio
+import os
+import re
 import sqlite3
+import sys
 import time
 from dataclasses import dataclass, asdict
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 from colorama import Fore, Style, init
 
-from agents import FakeLLM, HuggingFaceAgent, _TRANSFORMERS_OK
+from agents import FakeLLM, HuggingFaceAgent, _TRANSFORMERS_OK, agenerate_batch
 from tools import find_available_calendar_slot, book_calendar_event
 
 init(autoreset=True)
 
+PHI2_MODEL = "microsoft/phi-2"
+# Distilled BART gives near bart-large-cnn summaries at roughly twice the speed; override with SUMMARY_MODEL.
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "sshleifer/distilbart-cnn-12-6")
+
+_ROLE_COLORS = {
+    "ResearchBot": Fore.BLUE, "CreativeBot": Fore.MAGENTA,
+    "AnalysisBot": Fore.GREEN, "Moderator": Fore.YELLOW,
+    "TranscriptSummarizer": Fore.GREEN, "ActionItemExtractor": Fore.BLUE
+}
+
+# Anchored at the start of the reply, so only the prefix is ever scanned.
+_CONCLUSION_RE = re.compile(r"\s*CONCLUSION:", re.IGNORECASE)
+
+# Keyword routing for the schedule scenario; matches anywhere in the text, like the substring checks it replaces.
+_SCHEDULE_RE = re.compile(r"schedule|finalize|review", re.IGNORECASE)
+_TOPIC_RE = re.compile(r"budget|report", re.IGNORECASE)
+_MEETING_TITLES = {"budget": "Finalize Q4 Budget", "report": "Review Detailed Report"}  # checked in priority order
+
+_INSERT_SQL = "INSERT INTO contributions (ts, role, answer, confidence, rationale, iteration) VALUES (?,?,?,?,?,?)"
+
 @dataclass
 class Contribution:
     role: str
@@ -22,53 +46,80 @@ class Contribution:
     iteration: int
 
 class HistoryStore:
-    def __init__(self, path: str = "collab_history.db") -> None:
+    def __init__(self, path: str = "collab_history.db", durable_per_write: bool = False) -> None:
         self.path = path
+        # Unless durable_per_write is set, rows are buffered in memory and written in one transaction by flush().
+        self.durable_per_write = durable_per_write
+        self._buffer: List[Tuple[float, str, str, float, str, int]] = []
+        # A single connection is kept open for the store's lifetime instead of reconnecting per call.
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
         self._init()
 
     def _init(self) -> None:
-        con = sqlite3.connect(self.path)
-        cur = con.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS contributions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, role TEXT NOT NULL,
-                answer TEXT NOT NULL, confidence REAL NOT NULL, rationale TEXT NOT NULL, iteration INTEGER NOT NULL
+        with self.con:
+            self.con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS contributions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, role TEXT NOT NULL,
+                    answer TEXT NOT NULL, confidence REAL NOT NULL, rationale TEXT NOT NULL, iteration INTEGER NOT NULL
+                )
+                """
             )
-            """
-        )
-        con.commit()
-        con.close()
+            self.con.execute("CREATE INDEX IF NOT EXISTS idx_contributions_role_id ON contributions(role, id DESC)")
 
     def log(self, c: Contribution) -> None:
-        con = sqlite3.connect(self.path)
-        cur = con.cursor()
-        cur.execute(
-            "INSERT INTO contributions (ts, role, answer, confidence, rationale, iteration) VALUES (?,?,?,?,?,?)",
-            (time.time(), c.role, c.answer, c.confidence, c.rationale, c.iteration),
-        )
-        con.commit()
-        con.close()
-
-    def latest(self, limit: int = 10) -> List[Contribution]:
-        con = sqlite3.connect(self.path)
-        cur = con.cursor()
-        cur.execute(
-            "SELECT role, answer, confidence, rationale, iteration FROM contributions ORDER BY id DESC LIMIT ?", (limit,)
-        )
-        rows = cur.fetchall()
-        con.close()
+        self.log_many([c])
+
+    def log_many(self, contribs: List[Contribution]) -> None:
+        """Logs several contributions, committing them right away (in one transaction) if durable_per_write is set."""
+        ts = time.time()
+        self._buffer.extend((ts, c.role, c.answer, c.confidence, c.rationale, c.iteration) for c in contribs)
+        if self.durable_per_write:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered contributions in a single transaction."""
+        if not self._buffer:
+            return
+        with self.con:
+            self.con.executemany(_INSERT_SQL, self._buffer)
+        self._buffer.clear()
+
+    def latest(self, limit: int = 10, role: Optional[str] = None) -> List[Contribution]:
+        self.flush()
+        if role is None:
+            rows = self.con.execute(
+                "SELECT role, answer, confidence, rationale, iteration FROM contributions ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        else:
+            # Kept as a separate query (rather than "? IS NULL OR role = ?") so SQLite can seek idx_contributions_role_id.
+            rows = self.con.execute(
+                "SELECT role, answer, confidence, rationale, iteration FROM contributions WHERE role = ? ORDER BY id DESC LIMIT ?",
+                (role, limit),
+            ).fetchall()
         return [Contribution(role, answer, confidence, rationale, iteration) for role, answer, confidence, rationale, iteration in rows]
 
+    def close(self) -> None:
+        self.flush()
+        self.con.close()
+
 class Orchestrator:
     """Manages the entire multi-agent collaboration workflow."""
-    def __init__(self, store: HistoryStore, rounds: int = 2, use_hf: bool = False):
+    def __init__(self, store: HistoryStore, rounds: int = 2, use_hf: bool = False, max_concurrency: int = 2):
         self.store = store
         self.rounds = rounds
         self.use_hf = use_hf
-        self.board: Dict[str, Dict[str, Any]] = {}
+        # Caps how many agents run inference at once, so parallel HF pipelines don't exhaust GPU memory.
+        self.max_concurrency = max_concurrency
+        self.board: Dict[str, Contribution] = {}
+        self._board_text_cache: str = "(empty)"
         self.agents: Dict[str, Any] = {}
         self.moderator: Any = None
+        self._sem: Optional[asyncio.Semaphore] = None
+        # Per-role output headers, formatted once here rather than on every agent output.
+        self._role_header_fmt: Dict[str, str] = {role: self._header_fmt(role, color) for role, color in _ROLE_COLORS.items()}
 
     def _print_header(self, t: str) -> None:
         print("\n" + Fore.CYAN + "╔" + "═" * (len(t) + 2) + "╗")
@@ -76,104 +127,145 @@ class Orchestrator:
         print(Fore.CYAN + "╚" + "═" * (len(t) + 2) + "╝" + Style.RESET_ALL)
 
     def _print_agent_output(self, role: str, output: str, iteration: int = 1):
-        role_colors = {
-            "ResearchBot": Fore.BLUE, "CreativeBot": Fore.MAGENTA,
-            "AnalysisBot": Fore.GREEN, "Moderator": Fore.YELLOW,
-            "TranscriptSummarizer": Fore.GREEN, "ActionItemExtractor": Fore.BLUE
-        }
-        color = role_colors.get(role, Fore.WHITE)
-        print(color + f"\n▶ [{role} - Round {iteration}]" + Style.RESET_ALL)
-        for line in output.split('\n'):
-            print(f"  {line}")
+        header_fmt = self._role_header_fmt.get(role)
+        if header_fmt is None:
+            header_fmt = self._role_header_fmt[role] = self._header_fmt(role, Fore.WHITE)
+        # Header and indented body go out in one write rather than one print per line.
+        sys.stdout.write(header_fmt.format(i=iteration) + "  " + output.replace("\n", "\n  ") + "\n")
+
+    @staticmethod
+    def _header_fmt(role: str, color: str) -> str:
+        return f"{color}\n▶ [{role} - Round {{i}}]{Style.RESET_ALL}\n"
+
+    def _post(self, key: str, contrib: Contribution) -> None:
+        """Adds a contribution to the board and appends it to the cached board text."""
+        part = f"--- Contribution from {key} ---\n{contrib.answer}"
+        self._board_text_cache = f"{self._board_text_cache}\n\n{part}" if self.board else part
+        self.board[key] = contrib
+
+    @property
+    def board_dict(self) -> Dict[str, Dict[str, Any]]:
+        """The board as plain dicts, serialized only when a scenario returns it."""
+        return {key: asdict(contrib) for key, contrib in self.board.items()}
 
     def _board_text(self) -> str:
-        if not self.board:
-            return "(empty)"
-        parts = []
-        for agent_id in sorted(self.board.keys()):
-            data = self.board[agent_id]
-            parts.append(f"--- Contribution from {agent_id} ---\n{data['answer']}")
-        return "\n\n".join(parts)
-
-    # FIX: The missing method is now restored.
+        return self._board_text_cache
+
+    async def _agenerate(self, agent: Any, task: str, board: str) -> str:
+        async with self._sem:
+            return await agent.agenerate(task, board)
+
+    async def _agenerate_group(self, agents: List[Any], task: str, board: str) -> List[str]:
+        async with self._sem:
+            if len(agents) == 1:
+                return [await agents[0].agenerate(task, board)]
+            return await agenerate_batch(agents, task, board)
+
+    async def _run_round(self, task: str, r: int) -> str:
+        print(Fore.CYAN + f"\n--- Starting Round {r} ---")
+        # All agents in a round read the same snapshot of the board, so they can run concurrently.
+        board = self._board_text()
+        # Text-generation agents sharing a pipeline and decoding settings are submitted together as one batch.
+        groups: Dict[Any, List[str]] = {}
+        for role, agent in self.agents.items():
+            key = getattr(agent, "batch_key", None) or role
+            groups.setdefault(key, []).append(role)
+        results = await asyncio.gather(
+            *(asyncio.create_task(self._agenerate_group([self.agents[role] for role in roles], task, board))
+              for roles in groups.values())
+        )
+        outputs: Dict[str, str] = {}
+        for roles, group_outputs in zip(groups.values(), results):
+            outputs.update(zip(roles, group_outputs))
+        contribs = [Contribution(role, outputs[role], 0.8, "generated", r) for role in self.agents]
+        for contrib in contribs:
+            self._post(f"{contrib.role}-r{r}", contrib)
+            self._print_agent_output(contrib.role, contrib.answer, r)
+
+        mod_output = await self._agenerate(self.moderator, task, self._board_text())
+        contrib = Contribution("Moderator", mod_output, 0.9, "review", r)
+        self._post(f"Moderator-r{r}", contrib)
+        self._print_agent_output("Moderator", mod_output, r)
+        # Everything produced this round is persisted in one transaction.
+        self.store.log_many(contribs + [contrib])
+        return mod_output
+
     def run_research_collaboration(self, task: str):
+        return asyncio.run(self.arun_research_collaboration(task))
+
+    async def arun_research_collaboration(self, task: str):
         self._print_header(f"SCENARIO 1: Research Collaboration on '{task}'")
         
         if self.use_hf:
             self.agents = {
-                "ResearchBot": HuggingFaceAgent("ResearchBot", "microsoft/phi-2"),
-                "CreativeBot": HuggingFaceAgent("CreativeBot", "microsoft/phi-2"),
-                "AnalysisBot": HuggingFaceAgent("AnalysisBot", "facebook/bart-large-cnn"),
+                "ResearchBot": HuggingFaceAgent("ResearchBot", PHI2_MODEL),
+                "CreativeBot": HuggingFaceAgent("CreativeBot", PHI2_MODEL),
+                "AnalysisBot": HuggingFaceAgent("AnalysisBot", SUMMARY_MODEL),
             }
-            self.moderator = HuggingFaceAgent("Moderator", "microsoft/phi-2")
+            self.moderator = HuggingFaceAgent("Moderator", PHI2_MODEL)
         else:
             self.agents = { "ResearchBot": FakeLLM("ResearchBot"), "CreativeBot": FakeLLM("CreativeBot"), "AnalysisBot": FakeLLM("AnalysisBot") }
             self.moderator = FakeLLM("Moderator")
+        self._sem = asyncio.Semaphore(self.max_concurrency)
         
         final_report = "No conclusion reached after maximum rounds."
         for r in range(1, self.rounds + 1):
-            print(Fore.CYAN + f"\n--- Starting Round {r} ---")
-            for role, agent in self.agents.items():
-                output = agent.generate(task, self._board_text())
-                contrib = Contribution(role, output, 0.8, "generated", r)
-                self.store.log(contrib)
-                self.board[f"{role}-r{r}"] = asdict(contrib)
-                self._print_agent_output(role, output, r)
-
-            mod_output = self.moderator.generate(task, self._board_text())
-            contrib = Contribution("Moderator", mod_output, 0.9, "review", r)
-            self.store.log(contrib)
-            self.board[f"Moderator-r{r}"] = asdict(contrib)
-            self._print_agent_output("Moderator", mod_output, r)
+            mod_output = await self._run_round(task, r)
             
-            if mod_output.strip().upper().startswith("CONCLUSION:"):
+            conclusion = _CONCLUSION_RE.match(mod_output)
+            if conclusion:
                 print(Fore.GREEN + "\n--- Moderator concluded the task is complete. ---")
-                final_report = mod_output.replace("CONCLUSION:", "").strip()
+                final_report = mod_output[conclusion.end():].strip()
                 self._print_header("FINAL REPORT (SCENARIO 1)")
                 print(Fore.GREEN + final_report)
-                return {"board": self.board, "final": {"summary": final_report}}
+                self.store.flush()
+                return {"board": self.board_dict, "final": {"summary": final_report}}
             else:
                 print(Fore.YELLOW + f"\n--- Moderator requested another round of revisions. ---")
         
         self._print_header("FINAL REPORT (SCENARIO 1)")
         print(Fore.GREEN + final_report)
-        return {"board": self.board, "final": {"summary": final_report}}
+        self.store.flush()
+        return {"board": self.board_dict, "final": {"summary": final_report}}
 
     def run_schedule_optimization(self, transcript: str):
+        return asyncio.run(self.arun_schedule_optimization(transcript))
+
+    async def arun_schedule_optimization(self, transcript: str):
         self._print_header(f"SCENARIO 2: Schedule Optimization")
 
         self.agents = {
-            "TranscriptSummarizer": HuggingFaceAgent("TranscriptSummarizer", "facebook/bart-large-cnn"),
-            "ActionItemExtractor": HuggingFaceAgent("ActionItemExtractor", "microsoft/phi-2"),
+            "TranscriptSummarizer": HuggingFaceAgent("TranscriptSummarizer", SUMMARY_MODEL),
+            "ActionItemExtractor": HuggingFaceAgent("ActionItemExtractor", PHI2_MODEL),
         }
-        self.moderator = HuggingFaceAgent("Moderator", "microsoft/phi-2")
+        # The scenario's moderator step is plain keyword routing (see _SCHEDULE_RE), so no LLM is loaded for it.
+        self.moderator = None
+        self._sem = asyncio.Semaphore(self.max_concurrency)
         
         task = f"Analyze the following transcript, summarize it, and extract the key action item. Transcript:\n{transcript}"
+        action_item_task = "Based on the transcript, what is the single most important follow-up action item that requires scheduling? Respond with only the action itself."
         
-        summary = self.agents["TranscriptSummarizer"].generate(task, transcript)
-        contrib = Contribution("TranscriptSummarizer", summary, 0.8, "generated", 1)
-        self.store.log(contrib)
-        self.board["TranscriptSummarizer-r1"] = asdict(contrib)
-        self._print_agent_output("TranscriptSummarizer", summary)
-        
-        action_item_task = "Based on the transcript and summary, what is the single most important follow-up action item that requires scheduling? Respond with only the action itself."
-        action_items = self.agents["ActionItemExtractor"].generate(action_item_task, self._board_text())
-        contrib = Contribution("ActionItemExtractor", action_items, 0.8, "generated", 1)
-        self.store.log(contrib)
-        self.board["ActionItemExtractor-r1"] = asdict(contrib)
-        self._print_agent_output("ActionItemExtractor", action_items)
+        # The extractor reads the transcript directly rather than the summary, so both agents run concurrently.
+        summary, action_items = await asyncio.gather(
+            self._agenerate(self.agents["TranscriptSummarizer"], task, transcript),
+            self._agenerate(self.agents["ActionItemExtractor"], action_item_task, transcript),
+        )
+        contribs = [
+            Contribution("TranscriptSummarizer", summary, 0.8, "generated", 1),
+            Contribution("ActionItemExtractor", action_items, 0.8, "generated", 1),
+        ]
+        for contrib in contribs:
+            self._post(f"{contrib.role}-r1", contrib)
+            self._print_agent_output(contrib.role, contrib.answer)
         
         final_report_text = "CONCLUSION: No specific scheduling action item was identified."
         meeting_title = ""
         
-        action_lower = action_items.lower()
-        if "schedule" in action_lower or "finalize" in action_lower or "review" in action_lower:
-            if "budget" in action_lower:
-                meeting_title = "Finalize Q4 Budget"
-            elif "report" in action_lower:
-                meeting_title = "Review Detailed Report"
-            else:
-                meeting_title = "General Follow-up Meeting"
+        if _SCHEDULE_RE.search(action_items):
+            topics = {t.lower() for t in _TOPIC_RE.findall(action_items)}
+            meeting_title = next(
+                (title for topic, title in _MEETING_TITLES.items() if topic in topics), "General Follow-up Meeting"
+            )
 
             print(Fore.CYAN + "\n--- Executing Scheduling Task based on AI output ---")
             follow_up_time = find_available_calendar_slot(duration_minutes=45)
@@ -187,7 +279,8 @@ class Orchestrator:
             else:
                 final_report_text = "FAILURE: Could not schedule the meeting."
 
-        contrib = Contribution("Moderator", final_report_text, 0.9, "conclusion", 1)
-        self.store.log(contrib)
+        contribs.append(Contribution("Moderator", final_report_text, 0.9, "conclusion", 1))
+        self.store.log_many(contribs)
+        self.store.flush()
         self._print_header("FINAL REPORT (SCENARIO 2)")
         print(Fore.GREEN + final_report_text)
\ No newline at end of file
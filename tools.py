@@ -4,16 +4,18 @@
 
 import datetime
 
+_TRANSCRIPT = (
+        "Charles: OK team, for Q4 we need to focus on the holiday sales push. "
+        "Diana: Agreed. I've drafted a proposal for the social media campaign. "
+        "Charles: I've seen it, looks good. The main outstanding item is the budget. We need to lock that in. "
+        "Diana: Let's schedule a meeting to finalize the Q4 budget as soon as possible."
+)
+
 def get_meeting_transcript(meeting_id: str) -> str:
     """Simulates fetching a transcript from a service like Zoom or Otter.ai."""
     print(f"[Tool] Fetching transcript for meeting: {meeting_id}...")
     # In a real system, this would be a complex API call.
-    return (
-            "Charles: OK team, for Q4 we need to focus on the holiday sales push. "
-            "Diana: Agreed. I've drafted a proposal for the social media campaign. "
-            "Charles: I've seen it, looks good. The main outstanding item is the budget. We need to lock that in. "
-            "Diana: Let's schedule a meeting to finalize the Q4 budget as soon as possible."
-    )
+    return _TRANSCRIPT
 
 def find_available_calendar_slot(duration_minutes: int) -> str:
     """Simulates querying an API like Google Calendar to find an open time."""